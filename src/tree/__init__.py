@@ -1,5 +1,12 @@
+import errno
+import os
 import sys
 import re
+import stat
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from operator import attrgetter
 from pathlib import Path
 from typing import List
 
@@ -10,160 +17,480 @@ from .tree_exc import (
     TreeFileLimitError,
 )
 from .tree_parser import parser, __version__
-from .tree_format import CHARSETS, fmt_path, fmt_error
+from .tree_format import CHARSETS, fmt_path, fmt_error, stat_required
+from .tree_node import TreeNode, ErrorNode
 
 assert __version__
 
+_NUM_SPLIT = re.compile(r"([0-9]+)").split
 
-def tree_dir(path, ns, level=0):
-    tree_dict = {}
+
+def _stat_threads():
+    # A bad TREE_STAT_THREADS must not break importing the package
+    value = os.environ.get("TREE_STAT_THREADS", "16")
+    try:
+        threads = int(value)
+    except ValueError:
+        threads = 0
+    if threads < 1:
+        warnings.warn(
+            f"TREE_STAT_THREADS={value!r} is not a positive integer, using 16",
+            RuntimeWarning,
+        )
+        return 16
+    return threads
+
+
+_STAT_POOL = ThreadPoolExecutor(max_workers=_stat_threads())
+
+_WALK_POOL = ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2)
+
+_WALK_FAN_OUT = 4
+_STAT_CHUNK = 64
+_STAT_SORTS = frozenset({"mtime", "ctime", "size"})
+_STAT_DIR_FD = os.stat in os.supports_dir_fd and hasattr(os, "O_DIRECTORY")
+
+
+# Orders the entries of one directory the way their Path objects compare.
+# Siblings share their parent, so only the names need comparing; on
+# Windows, PureWindowsPath compares them case-insensitively
+if os.name == "nt":
+
+    def _path_order_key(item):
+        return os.path.normcase(item.name)
+
+else:
+    _path_order_key = attrgetter("name")
+
+
+def _version_key(name):
+    # Digit runs compare as integers, everything in between as text.
+    # Only ASCII runs are split out, and names never contain "/", so a
+    # chunk lying between "/" and ":" is exactly a run of 0-9
+    return [int(c) if "/" < c < ":" else c for c in _NUM_SPLIT(name)]
+
+
+def _needs_stat(ns):
+    # -F and -C read the entry type and execute bits from it as well
+    return bool(
+        stat_required(ns)
+        or ns.F
+        or ns.C
+        or ns.t
+        or ns.c
+        or (ns.sort and ns.sort.lower() in _STAT_SORTS)
+    )
+
+
+# The errors pathlib's is_dir()/is_symlink() treat as "no such file"
+# rather than raise; anything else, such as EACCES, still propagates
+_IGNORED_ERRNOS = frozenset({errno.ENOENT, errno.ENOTDIR, errno.EBADF, errno.ELOOP})
+_IGNORED_WINERRORS = frozenset({21, 123, 1921})
+
+
+def _ignored_error(err):
+    return (
+        err.errno in _IGNORED_ERRNOS
+        or getattr(err, "winerror", None) in _IGNORED_WINERRORS
+    )
+
+
+def _entry_is_dir(entry):
+    # Like Path.is_dir(), an entry whose target is missing or loops is not
+    # a directory
+    try:
+        return entry.is_dir()
+    except OSError as err:
+        if _ignored_error(err):
+            return False
+        raise
+
+
+def _entry_is_link(entry):
+    # Like Path.is_symlink(), an entry that is missing is not a link
+    try:
+        return entry.is_symlink()
+    except OSError as err:
+        if _ignored_error(err):
+            return False
+        raise
+
+
+def _try_stat(entry, dir_fd=None):
+    # Failures are left for the consumer to re-raise from path.stat(),
+    # so they surface at the same point of the output as before
+    try:
+        if dir_fd is not None:
+            return os.stat(entry.name, dir_fd=dir_fd)
+        # On Windows DirEntry.stat() leaves st_ino, st_dev and st_nlink at 0,
+        # which --inodes and --device would print
+        if os.name == "nt":
+            return os.stat(entry.path)
+        return entry.stat()
+    except OSError:
+        return None
+
+
+def _stat_chunk(entries, dir_fd=None):
+    return [_try_stat(entry, dir_fd) for entry in entries]
+
+
+def _open_dir_fd(path):
+    if not _STAT_DIR_FD:
+        return None
+    try:
+        return os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return None
+
+
+def _stat_all(path, entries):
+    """
+    Stats the entries of the directory `path`.
+    Where supported, names are resolved relative to an open descriptor of
+    the directory (fstatat), which spares the kernel a full path lookup
+    per entry.
+    """
+    dir_fd = _open_dir_fd(path)
+    try:
+        # Small listings are cheaper to stat inline than to hand over to the pool
+        if len(entries) <= _STAT_CHUNK:
+            return _stat_chunk(entries, dir_fd)
+        chunks = [
+            entries[i : i + _STAT_CHUNK] for i in range(0, len(entries), _STAT_CHUNK)
+        ]
+        results = _STAT_POOL.map(_stat_chunk, chunks, [dir_fd] * len(chunks))
+        return [st for chunk in results for st in chunk]
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+
+
+def _list_dir(path, ns, level):
+    """
+    Reads a single directory into a list of TreeNode.
+    Subdirectories come back unread, with their contents left as None.
+    """
     if ns.L and level >= int(ns.L):
-        return tree_dict
+        return []
     try:
-        items = sorted(path.iterdir())
+        # DirEntry keeps the file type reported by the directory read,
+        # so telling directories from files costs no extra syscall
+        with os.scandir(path) as it:
+            entries = list(it)
     except OSError as err:
-        return {"Error": TreePermissionError(str(err))}
+        return [ErrorNode(TreePermissionError(str(err)))]
+
+    if ns.filelimit and len(entries) > int(ns.filelimit):
+        return [ErrorNode(TreeFileLimitError(len(entries)))]
+
+    if not ns.a:
+        # scandir never yields "." or "..", nor an empty name, so the first
+        # character alone tells a dotfile
+        entries = [entry for entry in entries if entry.name[0] != "."]
+
+    # Ordering by name, as Path objects would compare, skips building a
+    # Path for every comparison
+    entries.sort(key=_path_order_key)
+
+    nodes = [
+        TreeNode(Path(entry.path), entry.name, is_dir=_entry_is_dir(entry))
+        for entry in entries
+    ]
+    if ns.F or ns.C:
+        # -F and -C mark symlinks, which the directory read already reports
+        for node, entry in zip(nodes, entries):
+            node.is_link = _entry_is_link(entry)
+    if ns._needs_stat:
+        listed = list(zip(nodes, entries))
+        # Entries left out by -P/-I are neither printed nor sorted,
+        # so only the listed ones are stat'ed
+        if ns._prefilter:
+            listed = [(node, entry) for node, entry in listed if _is_listed(node, ns)]
+        stats = _stat_all(path, [entry for _, entry in listed])
+        for (node, _), st in zip(listed, stats):
+            node.st = st
+            # The fd-relative stat and the full-path DirEntry lookup can
+            # disagree, e.g. at the depth where a symlink loop hits ELOOP;
+            # the stat also drives the mode column and -F, so it wins
+            if st is not None:
+                node.is_dir = stat.S_ISDIR(st.st_mode)
+    return nodes
+
+
+def _read_dirs(nodes, ns, level):
+    """
+    Reads the listings of the unread directories among `nodes`, which sit
+    at depth `level`. When there are more than a few, they are listed
+    concurrently on a thread pool, so the latency of directory reads
+    overlaps on slow or remote storage.
+    """
+    unread = [node for node in nodes if node.is_dir and node.contents is None]
+    if len(unread) > _WALK_FAN_OUT:
+        listings = _WALK_POOL.map(
+            _list_dir, [node.path for node in unread], repeat(ns), repeat(level)
+        )
+    else:
+        listings = (_list_dir(node.path, ns, level) for node in unread)
+    for node, contents in zip(unread, listings):
+        node.contents = contents
 
-    if ns.filelimit and len(items) > int(ns.filelimit):
-        return {"Error": TreeFileLimitError(len(items))}
 
-    for item in items:
-        if not ns.a and item.name.startswith("."):
-            continue
-        if item.is_dir():
-            subdir_dict = tree_dir(item, ns, level + 1)
-            if subdir_dict:
-                tree_dict[item] = subdir_dict
-        else:
-            tree_dict[item] = ""
-    return tree_dict
+def _is_shown(node, ns, level):
+    """
+    Tells whether the node has anything to show, directories being left
+    out when nothing below them is listed. Unread directories are read on
+    demand, at depth `level`, and only as far as the first entry to show.
+    """
+    stack = [(node, level)]
+    while stack:
+        node, level = stack.pop()
+        if not node.is_dir:
+            return True
+        if node.contents is None:
+            node.contents = _list_dir(node.path, ns, level)
+        if any(not child.is_dir for child in node.contents):
+            return True
+        stack.extend((child, level + 1) for child in reversed(node.contents))
+    return False
+
+
+def _shown(nodes, ns, level):
+    # `nodes` is a listing at depth `level - 1`; its directories list at `level`
+    _read_dirs(nodes, ns, level)
+    return [node for node in nodes if _is_shown(node, ns, level)]
+
+
+class _InvalidPattern:
+    """
+    Stands in for a -P/-I pattern that does not compile; searching it
+    raises the compile error, so it fails at the first name matched
+    against it, as an uncompiled pattern would.
+    """
+
+    __slots__ = ("error",)
+
+    def __init__(self, error):
+        self.error = error
+
+    def search(self, name):
+        raise self.error
 
 
-def check_pattern(name, pattern, ignore_case=False):
+def _compile_pattern(pattern, flags):
     if not pattern:
+        return None
+    try:
+        return re.compile(pattern, flags)
+    except re.error as err:
+        return _InvalidPattern(err)
+
+
+def compile_patterns(ns):
+    """
+    Compiles the -P and -I patterns and keeps them on the namespace as
+    `_P_re` and `_I_re` (None when the option is not set).
+    """
+    flags = re.IGNORECASE if ns.ignore_case else 0
+    ns._P_re = _compile_pattern(ns.P, flags)
+    ns._I_re = _compile_pattern(ns.I, flags)
+    # Listings are only pre-filtered for stat'ing when that cannot raise;
+    # otherwise the error is left to the filtering at print time
+    ns._prefilter = bool(ns._P_re or ns._I_re) and not any(
+        isinstance(p, _InvalidPattern) for p in (ns._P_re, ns._I_re)
+    )
+
+
+def _is_listed(node, ns):
+    # Directories are only matched against patterns with --matchdirs
+    if isinstance(node, ErrorNode) or (node.is_dir and not ns.matchdirs):
         return True
-    flags = re.IGNORECASE if ignore_case else 0
-    return re.search(pattern, name, flags=flags) is not None
+    # The compiled patterns are searched directly, as this runs per entry
+    i_re, p_re = ns._I_re, ns._P_re
+    if i_re is not None and i_re.search(node.name) is not None:
+        return False
+    return p_re is None or p_re.search(node.name) is not None
 
 
-def filter_tree(tree_dict, ns):
-    filtered_dict = {}
-    for item, content in tree_dict.items():
-        name = item.name if isinstance(item, Path) else str(item)
-        if item == "Error" and isinstance(content, TreeError):
-            filtered_dict[item] = str(content)
-            continue
+def filter_tree(nodes, ns):
+    if not (ns._P_re or ns._I_re):
+        return nodes
 
-        should_match_pattern = (
-            isinstance(content, dict) and ns.matchdirs or not isinstance(content, dict)
-        )
+    return [node for node in nodes if _is_listed(node, ns)]
 
-        if ns.I and should_match_pattern:
-            if check_pattern(name, ns.I, ns.ignore_case):
-                continue
-        if ns.P and should_match_pattern:
-            if not check_pattern(name, ns.P, ns.ignore_case):
-                continue
-        filtered_dict[item] = content
-    return filtered_dict
 
+def _stat_key(nodes, field):
+    """
+    Returns a key reading `field` from the stat results of the nodes.
+    Nodes whose stat was not prefetched are stat'ed first, so a failing
+    stat raises here just as it would while sorting.
+    """
+    for node in nodes:
+        if node.st is None:
+            node.stat()
+    return attrgetter("st." + field)
 
-def sort_tree(tree_dict, ns):
+
+def compile_sort(ns):
     """
-    Sorts a dictionary representing a file tree based on user-defined options.
+    Resolves the sort options and keeps the result on the namespace as
+    `_sort_by` and `_sort_desc`. `_sort_by` is "name", "version", a stat
+    field, or None for the default order. An invalid --sort is left for
+    sort_tree to reject.
     """
-    # The 'items' to be sorted are the key-value pairs of the dictionary
-    items = list(tree_dict.items())
+    sort = ns.sort.lower() if ns.sort else None
 
+    # No sorting if '-U' is present or if sorting by a specific key that's not 'name'
+    if ns.U or sort == "name":
+        ns._sort_by, ns._sort_desc = "name", False
+    # Sort by version if '-v' is specified
+    elif ns.v or sort == "version":
+        ns._sort_by, ns._sort_desc = "version", False
+    # Sort by modification time if '-t' is specified
+    elif ns.t or sort == "mtime":
+        ns._sort_by, ns._sort_desc = "st_mtime", True
+    # Sort by status change time if '-c' is specified
+    elif ns.c or sort == "ctime":
+        ns._sort_by, ns._sort_desc = "st_ctime", True
+    # Sort by size if '--sort size' is specified
+    elif sort == "size":
+        ns._sort_by, ns._sort_desc = "st_size", False
+    # The default sort is by name if no other option is specified
+    else:
+        ns._sort_by, ns._sort_desc = None, False
+
+
+def _lower_name_key(node):
+    return node.name.lower()
+
+
+def _version_name_key(node):
+    # A simple version sort can be achieved by splitting and comparing parts
+    return _version_key(node.name.lower())
+
+
+def _sort_key(nodes, ns):
+    sort_by = ns._sort_by
+    if sort_by == "name":
+        return _lower_name_key
+    if sort_by == "version":
+        return _version_name_key
+    if sort_by is None:
+        # The default sort is by path, which _path_order_key mirrors
+        return _path_order_key
+    return _stat_key(nodes, sort_by)
+
+
+def sort_tree(nodes, ns):
+    """
+    Sorts the nodes of a single directory based on user-defined options.
+    The list is ordered in place and returned.
+    """
     if ns.sort and ns.sort not in TreeSortTypeError.possible_values:
         raise TreeSortTypeError
 
-    # No sorting if '-U' is present or if sorting by a specific key that's not 'name'
-    if ns.U or (ns.sort and ns.sort.lower() == "name"):
-        # The default sorted() behavior is by name, so no custom key is needed here
-        sorted_items = sorted(items, key=lambda x: x[0].name.lower())
+    # Nothing to order; this also covers a lone ErrorNode, which has no path
+    if len(nodes) < 2:
+        return nodes
 
-    # Sort by version if '-v' is specified
-    elif ns.v or (ns.sort and ns.sort.lower() == "version"):
-        # A simple version sort can be achieved by splitting and comparing parts
-        def version_key(item):
-            name = item[0].name.lower()
-            return [int(c) if c.isdigit() else c for c in re.split("([0-9]+)", name)]
+    key = _sort_key(nodes, ns)
 
-        sorted_items = sorted(items, key=version_key)
+    # Handle the '--dirsfirst' option, but only if '-U' is not present.
+    # Sorting is stable, so splitting directories from files first and
+    # sorting each part gives the same order for less work
+    if ns.dirsfirst and not ns.U:
+        dirs, files = [], []
+        for item in nodes:
+            (dirs if item.is_dir else files).append(item)
+        parts = (dirs, files)
+    else:
+        parts = (nodes,)
 
-    # Sort by modification time if '-t' is specified
-    elif ns.t or (ns.sort and ns.sort.lower() == "mtime"):
-        sorted_items = sorted(items, key=lambda x: x[0].stat().st_mtime, reverse=True)
+    for part in parts:
+        part.sort(key=key, reverse=ns._sort_desc)
+        # Reverse the sort order if '-r' is specified
+        if ns.r:
+            part.reverse()
 
-    # Sort by status change time if '-c' is specified
-    elif ns.c or (ns.sort and ns.sort.lower() == "ctime"):
-        sorted_items = sorted(items, key=lambda x: x[0].stat().st_ctime, reverse=True)
+    if len(parts) > 1:
+        nodes[:] = dirs + files
+    return nodes
 
-    # Sort by size if '--sort size' is specified
-    elif ns.sort and ns.sort.lower() == "size":
-        sorted_items = sorted(items, key=lambda x: x[0].stat().st_size)
 
-    # The default sort is by name if no other option is specified
-    else:
-        sorted_items = sorted(items)
+def walk_tree(nodes, ns):
+    """
+    Yields (level, node, is_last) for every node to print, in output order.
 
-    # Reverse the sort order if '-r' is specified
-    if ns.r:
-        sorted_items = sorted_items[::-1]
+    `nodes` is a single listing from _list_dir; subdirectories are read
+    as the walk reaches them. Printed subtrees are dropped as the walk
+    moves on, so memory follows the current branch rather than the whole
+    tree.
 
-    # Handle the '--dirsfirst' option, but only if '-U' is not present
-    if ns.dirsfirst and not ns.U:
-        # Separate directories and files
-        dirs = [item for item in sorted_items if item[0].is_dir()]
-        files = [item for item in sorted_items if not item[0].is_dir()]
-        sorted_items = dirs + files
+    Subdirectories are walked with an explicit stack rather than by
+    recursion, so deep trees cost no extra Python frames and cannot hit
+    the recursion limit.
+    """
+    items = _shown(nodes, ns, 1)
+    nodes = None
+    if not items:
+        return
+
+    items = sort_tree(filter_tree(items, ns), ns)
+    # Each frame keeps the not yet yielded nodes of one directory, reversed
+    # so that popping releases them in output order
+    stack = [items[::-1]]
+
+    while stack:
+        pending = stack[-1]
+        if not pending:
+            stack.pop()
+            continue
+        node = pending.pop()
+        level = len(stack) - 1
+        yield level, node, not pending
 
-    return sorted_items
+        if node.is_dir:
+            sub_items = _shown(node.contents, ns, level + 2)
+            stack.append(sort_tree(filter_tree(sub_items, ns), ns)[::-1])
 
 
-def print_tree(tree_dict, ns, prefix="", path_root=None):
+def print_tree(nodes, ns, prefix="", path_root=None):
+    """
+    Prints the nodes as walk_tree yields them and returns the
+    (directories, files) totals. Each line is written as soon as it is
+    known.
+    """
     charset = CHARSETS.get(ns.charset, CHARSETS["utf-8"])
+    # The connectors are looked up once rather than per line; -i drops them
+    if ns.i:
+        prefix = branch = last = vertical = space = ""
+    else:
+        branch, last = charset["branch"], charset["last"]
+        vertical, space = charset["vertical"], charset["space"]
+    # Each line goes out in a single write
+    write = ns.o.write
+
     if path_root:
-        print(Path(path_root).as_posix(), file=ns.o)
-    if not tree_dict:
-        return 0, 0
+        write(f"{Path(path_root).as_posix()}\n")
 
     dirs, files = 0, 0
-    filtered_dict = filter_tree(tree_dict, ns)
-    items = sort_tree(filtered_dict, ns)
-
-    for i, (item, content) in enumerate(items):
-        is_last = i == len(items) - 1
-
-        # Initialize new_prefix_item to avoid potential UnboundLocalError
-        new_prefix_item = ""
-
-        if ns.i:
-            line_prefix = ""
-            new_next_prefix = ""
-        else:
-            line_prefix = prefix
-            new_prefix_item = charset["last"] if is_last else charset["branch"]
-            new_next_prefix = prefix + (
-                charset["space"] if is_last else charset["vertical"]
-            )
-
-        if item == "Error" and isinstance(content, str):
-            print(f"{line_prefix}{new_prefix_item}{fmt_error(content, ns)}", file=ns.o)
+    # prefixes[level] is the indentation of the lines at that level
+    prefixes = [prefix]
+    for level, node, is_last in walk_tree(nodes, ns):
+        prefix = prefixes[level]
+        connector = last if is_last else branch
+
+        if isinstance(node, ErrorNode):
+            write(f"{prefix}{connector}{fmt_error(node.error, ns)}\n")
             continue
 
-        path_name = fmt_path(item, ns)
+        path_name = fmt_path(node.path, ns, node.st, node.is_link)
+        write(f"{prefix}{connector}{path_name}\n")
 
-        if not ns.i:
-            print(f"{line_prefix}{new_prefix_item}{path_name}", file=ns.o)
-        else:
-            print(f"{path_name}", file=ns.o)
-
-        if isinstance(content, dict):
-            sub_dirs, sub_files = print_tree(content, ns, prefix=new_next_prefix)
-            dirs += 1 + sub_dirs
-            files += sub_files
+        if node.is_dir:
+            dirs += 1
+            del prefixes[level + 1 :]
+            prefixes.append(prefix + (space if is_last else vertical))
         else:
             files += 1
     return dirs, files
@@ -202,13 +529,24 @@ def print_tree(tree_dict, ns, prefix="", path_root=None):
 #     return dirs, files
 
 
+def resolve_options(ns):
+    """
+    Works out once per run what the options ask of the walk, filtering and
+    sorting, and keeps it on the namespace, so the per-directory code (run
+    on pool threads too) only reads it.
+    """
+    compile_patterns(ns)
+    compile_sort(ns)
+    ns._needs_stat = _needs_stat(ns)
+
+
 def tree(ns, paths: List[Path]):
+    resolve_options(ns)
     total_dirs, total_files = 0, 0
     for i, path_str in enumerate(paths):
         path = Path(path_str)
         if path.is_dir():
-            tree_dict = tree_dir(path, ns)
-            dirs, files = print_tree(tree_dict, ns, path_root=path)
+            dirs, files = print_tree(_list_dir(path, ns, 0), ns, path_root=path)
             total_dirs += dirs
             total_files += files
         else:
@@ -236,9 +574,12 @@ def run_recursive_tree(ns):
         if not current_path.is_dir():
             return
         try:
-            for item in current_path.iterdir():
-                if item.is_dir():
-                    find_dirs_at_level(item, current_level + 1, found_dirs)
+            # DirEntry.is_dir() answers from the directory read for all but
+            # symlinks, sparing a stat per entry
+            with os.scandir(current_path) as it:
+                subdirs = [Path(entry.path) for entry in it if _entry_is_dir(entry)]
+            for item in subdirs:
+                find_dirs_at_level(item, current_level + 1, found_dirs)
         except OSError:
             pass
 
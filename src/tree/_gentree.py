@@ -7,10 +7,6 @@ from pathlib import Path
 
 __version__ = "0.1.0"
 
-with open(Path(__file__).parent / "_tree_help.sh") as fp:
-    ff = fp.read()
-
-
 optp = """group{group}.add_argument(
     "{flag}",
     action="store",
@@ -65,78 +61,97 @@ lookup_without_metavar = r"^  (--*[-\w]+)\s+([A-Z].+)$"
 special_lookup = r"^  (--+)\s+([A-Z].+)$"
 
 
-g = 0
-lines = []
-lines.append("import argparse")
-lines.append("from pathlib import Path")
-lines.append(f"\n__version__ = '{__version__}'")
-lines.append("\n__all__ = ('parser',)")
-lines.append("\n")
-lines.append("parser = argparse.ArgumentParser(description=__doc__, add_help=False)")
-lines.append("parser.version = __version__")
-for i, li in enumerate(ff.split("\n")):
-    if re.search(section, li):
-        lines.append(f'group{g} = parser.add_argument_group("{li}")')
-        g += 1
-    elif re.search(special_lookup, li):
-        flag = re.search(special_lookup, li).group(1)
-        dest = known_arg_dests[flag]
-        lines.append(
-            special_flagp.format(
-                group=g - 1,
-                flag=flag.strip(),
-                dest=dest,
-                help="Options processing terminator.",
-            )
-        )
-    else:
-        m = re.search(lookup_with_metavar, li)
-        if m:
-            gr = m.groups()
-            flag, metavar, help_ = gr
-            flag = flag.strip()
-            metavar = metavar.strip()
-            help_ = help_.strip()
-            if flag in known_arg_types:
-                type_ = known_arg_types[flag]
-                lines.append(
-                    optp.format(
-                        group=g - 1, flag=flag, metavar=metavar, type=type_, help=help_
-                    )
+def main():
+    """
+    Regenerates `tree_parser.py` from the help text in `_tree_help.sh`.
+    """
+    with open(Path(__file__).parent / "_tree_help.sh") as fp:
+        ff = fp.read()
+
+    g = 0
+    lines = []
+    lines.append("import argparse")
+    lines.append("from pathlib import Path")
+    lines.append(f"\n__version__ = '{__version__}'")
+    lines.append("\n__all__ = ('parser',)")
+    lines.append("\n")
+    lines.append(
+        "parser = argparse.ArgumentParser(description=__doc__, add_help=False)"
+    )
+    lines.append("parser.version = __version__")
+    for i, li in enumerate(ff.split("\n")):
+        if re.search(section, li):
+            lines.append(f'group{g} = parser.add_argument_group("{li}")')
+            g += 1
+        elif re.search(special_lookup, li):
+            flag = re.search(special_lookup, li).group(1)
+            dest = known_arg_dests[flag]
+            lines.append(
+                special_flagp.format(
+                    group=g - 1,
+                    flag=flag.strip(),
+                    dest=dest,
+                    help="Options processing terminator.",
                 )
-            else:
-                lines.append(flagp.format(group=g - 1, flag=flag, help=help_))
+            )
         else:
-            m = re.search(lookup_without_metavar, li)
+            m = re.search(lookup_with_metavar, li)
             if m:
                 gr = m.groups()
-                flag, help_ = gr
-                if flag == "--help":
+                flag, metavar, help_ = gr
+                flag = flag.strip()
+                metavar = metavar.strip()
+                help_ = help_.strip()
+                if flag in known_arg_types:
+                    type_ = known_arg_types[flag]
                     lines.append(
-                        spec_action_flag.format(
+                        optp.format(
                             group=g - 1,
-                            action="help",
-                            flag=flag.strip(),
-                            help=help_.strip(),
-                        )
-                    )
-                elif flag == "--version":
-                    lines.append(
-                        spec_action_flag.format(
-                            group=g - 1,
-                            action="version",
-                            flag=flag.strip(),
-                            help=help_.strip(),
+                            flag=flag,
+                            metavar=metavar,
+                            type=type_,
+                            help=help_,
                         )
                     )
                 else:
-                    lines.append(
-                        flagp.format(group=g - 1, flag=flag.strip(), help=help_.strip())
-                    )
+                    lines.append(flagp.format(group=g - 1, flag=flag, help=help_))
+            else:
+                m = re.search(lookup_without_metavar, li)
+                if m:
+                    gr = m.groups()
+                    flag, help_ = gr
+                    if flag == "--help":
+                        lines.append(
+                            spec_action_flag.format(
+                                group=g - 1,
+                                action="help",
+                                flag=flag.strip(),
+                                help=help_.strip(),
+                            )
+                        )
+                    elif flag == "--version":
+                        lines.append(
+                            spec_action_flag.format(
+                                group=g - 1,
+                                action="version",
+                                flag=flag.strip(),
+                                help=help_.strip(),
+                            )
+                        )
+                    else:
+                        lines.append(
+                            flagp.format(
+                                group=g - 1, flag=flag.strip(), help=help_.strip()
+                            )
+                        )
+
+    lines.append(positional)
+    lines.append("\n")
+    # lines.append("ns = parser.parse_args()")
+    # lines.append("print(ns)")
+    with open(Path(__file__).parent / "tree_parser.py", "w") as fp:
+        fp.write("\n".join(lines))
+
 
-lines.append(positional)
-lines.append("\n")
-# lines.append("ns = parser.parse_args()")
-# lines.append("print(ns)")
-with open(Path(__file__).parent / "tree_parser.py", "w") as fp:
-    fp.write("\n".join(lines))
+if __name__ == "__main__":
+    main()
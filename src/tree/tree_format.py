@@ -1,10 +1,19 @@
 import argparse
+import bisect
+import functools
+import math
 import os
 import stat
 import mimetypes
 from datetime import datetime
 from pathlib import Path
-from typing import Tuple, Any
+from typing import Tuple, Any, Optional
+
+try:
+    import pwd
+    import grp
+except ImportError:  # not available on Windows
+    pwd = grp = None
 
 CONSOLE_WIDTH = 35
 
@@ -35,42 +44,41 @@ BOLD_GREEN = BOLD + GREEN
 BOLD_RED = BOLD + RED
 BOLD_MAGENTA = BOLD + MAGENTA
 
+# Size units for -h (powers of 1024) and --si (powers of 1000)
+_UNITS_1024 = ("B", "K", "M", "G", "T", "P", "E", "Z", "Y")
+_UNITS_1000 = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+_LIMITS_1000 = tuple(1000**i for i in range(1, len(_UNITS_1000)))
+
+# Substrings marking an archive among application/* MIME types
+_ARCHIVE_MIME_MARKERS = ("zip", "tar", "gzip", "compressed", "x-bzip2", "x-xz")
+
+
+# "rwx" strings for each 3-bit permission group, and the same with the
+# execute slot showing setuid/setgid ("s"/"S") or sticky ("t"/"T")
+_RWX = ("---", "--x", "-w-", "-wx", "r--", "r-x", "rw-", "rwx")
+_RWX_SETID = tuple(rwx[:2] + ("s" if rwx[2] == "x" else "S") for rwx in _RWX)
+_RWX_STICKY = tuple(rwx[:2] + ("t" if rwx[2] == "x" else "T") for rwx in _RWX)
+
+# Permission bits have only 4096 combinations, so every string is built
+# once up front and looked up per file
+_PERM_STRINGS = tuple(
+    (_RWX_SETID if mode & stat.S_ISUID else _RWX)[mode >> 6 & 7]
+    + (_RWX_SETID if mode & stat.S_ISGID else _RWX)[mode >> 3 & 7]
+    + (_RWX_STICKY if mode & stat.S_ISVTX else _RWX)[mode & 7]
+    for mode in range(0o10000)
+)
+_TYPE_CHARS = {
+    stat.S_IFDIR: "d",
+    stat.S_IFLNK: "l",
+    stat.S_IFCHR: "c",
+    stat.S_IFBLK: "b",
+    stat.S_IFIFO: "p",
+    stat.S_IFSOCK: "s",
+}
+
 
 def _perms_to_str(st_mode):
-    file_type = "-"
-    if stat.S_ISDIR(st_mode):
-        file_type = "d"
-    elif stat.S_ISLNK(st_mode):
-        file_type = "l"
-    elif stat.S_ISCHR(st_mode):
-        file_type = "c"
-    elif stat.S_ISBLK(st_mode):
-        file_type = "b"
-    elif stat.S_ISFIFO(st_mode):
-        file_type = "p"
-    elif stat.S_ISSOCK(st_mode):
-        file_type = "s"
-
-    perms = ""
-    perms += "r" if st_mode & stat.S_IRUSR else "-"
-    perms += "w" if st_mode & stat.S_IWUSR else "-"
-    perms += "x" if st_mode & stat.S_IXUSR else "-"
-    perms += "r" if st_mode & stat.S_IRGRP else "-"
-    perms += "w" if st_mode & stat.S_IWGRP else "-"
-    perms += "x" if st_mode & stat.S_IXGRP else "-"
-    perms += "r" if st_mode & stat.S_IROTH else "-"
-    perms += "w" if st_mode & stat.S_IWOTH else "-"
-    perms += "x" if st_mode & stat.S_IXOTH else "-"
-
-    # setuid, setgid, sticky
-    if st_mode & stat.S_ISUID:
-        perms = perms[:2] + ("s" if perms[2] == "x" else "S") + perms[3:]
-    if st_mode & stat.S_ISGID:
-        perms = perms[:5] + ("s" if perms[5] == "x" else "S") + perms[6:]
-    if st_mode & stat.S_ISVTX:
-        perms = perms[:8] + ("t" if perms[8] == "x" else "T")
-
-    return file_type + perms
+    return _TYPE_CHARS.get(stat.S_IFMT(st_mode), "-") + _PERM_STRINGS[st_mode & 0o7777]
 
 
 def _get_fullname_str(path: Path, ns: argparse.Namespace) -> str:
@@ -78,6 +86,10 @@ def _get_fullname_str(path: Path, ns: argparse.Namespace) -> str:
 
 
 def _escape_non_printable(path_name: str, ns: argparse.Namespace) -> str:
+    # Almost every name is printable as a whole, which str.isprintable()
+    # tells in C without taking the name apart
+    if path_name.isprintable():
+        return path_name
     if ns.q:
         path_name = "".join(c if c.isprintable() else "?" for c in path_name)
     elif not ns.N:
@@ -91,7 +103,69 @@ def _get_quotes(path_name: str, ns: argparse.Namespace) -> str:
     return path_name
 
 
-def _colorize(path: Path, path_name: str, ns: argparse.Namespace) -> str:
+def _is_dir(path: Path, st: Optional[os.stat_result]) -> bool:
+    # The stat result follows symlinks just like Path.is_dir()
+    if st is not None:
+        return stat.S_ISDIR(st.st_mode)
+    return path.is_dir()
+
+
+def _is_symlink(path: Path, is_link: Optional[bool]) -> bool:
+    if is_link is not None:
+        return is_link
+    return path.is_symlink()
+
+
+def _is_executable(path: Path, st: Optional[os.stat_result]) -> bool:
+    # On POSIX, without any execute bit access() never grants X_OK, not
+    # even to root or through ACLs; otherwise it has the final say. Windows
+    # grants X_OK to any existing file and only sets the bits by extension,
+    # so there access() always decides
+    if os.name != "nt" and st is not None and not st.st_mode & 0o111:
+        return False
+    return os.access(path, os.X_OK)
+
+
+def _mime_key(name: str) -> str:
+    # mimetypes only looks at the extensions, so names that agree from their
+    # first dot on get the same guess; leading dots do not start one. The
+    # key is kept an absolute path so that a ":" is never read as a scheme
+    name = name.lstrip(".")
+    stem_end = name.find(".")
+    if stem_end < 0:
+        return "/x"
+    return "/x" + name[stem_end:]
+
+
+@functools.lru_cache(maxsize=1024)
+def _mime_color(mime_key: str) -> str:
+    # Use mimetypes to guess the file's MIME type
+    mime_type, _ = mimetypes.guess_type(mime_key)
+
+    color = ""
+    if mime_type:
+        # Assign colors based on the general MIME type category
+        if mime_type.startswith("image/"):
+            color = MAGENTA
+        elif mime_type.startswith("audio/"):
+            color = CYAN
+        elif mime_type.startswith("video/"):
+            color = MAGENTA
+        elif mime_type.startswith("application/"):
+            # For archives, check for common substrings in the MIME type
+            if any(x in mime_type for x in _ARCHIVE_MIME_MARKERS):
+                color = BOLD_RED
+        # No color for text or other generic file types
+    return color
+
+
+def _colorize(
+    path: Path,
+    path_name: str,
+    ns: argparse.Namespace,
+    st: Optional[os.stat_result] = None,
+    is_link: Optional[bool] = None,
+) -> str:
     """
     Applies color to the path name based on the file type.
     """
@@ -104,34 +178,16 @@ def _colorize(path: Path, path_name: str, ns: argparse.Namespace) -> str:
     if ns.C:
         color = ""
         # Check for directories first, as it's the most common and highest priority type
-        if path.is_dir():
+        if _is_dir(path, st):
             color = BOLD_BLUE
         # Check for symbolic links
-        elif path.is_symlink():
+        elif _is_symlink(path, is_link):
             color = BOLD_CYAN
         # Check for executable files
-        elif os.access(path, os.X_OK):
+        elif _is_executable(path, st):
             color = BOLD_GREEN
         else:
-            # Use mimetypes to guess the file's MIME type
-            mime_type, _ = mimetypes.guess_type(path)
-
-            if mime_type:
-                # Assign colors based on the general MIME type category
-                if mime_type.startswith("image/"):
-                    color = MAGENTA
-                elif mime_type.startswith("audio/"):
-                    color = CYAN
-                elif mime_type.startswith("video/"):
-                    color = MAGENTA
-                elif mime_type.startswith("application/"):
-                    # For archives, check for common substrings in the MIME type
-                    if any(
-                        x in mime_type
-                        for x in ["zip", "tar", "gzip", "compressed", "x-bzip2", "x-xz"]
-                    ):
-                        color = BOLD_RED
-                # No color for text or other generic file types
+            color = _mime_color(_mime_key(path.name))
 
         if color:
             return color + path_name + RESET
@@ -184,86 +240,114 @@ def _colorize(path: Path, path_name: str, ns: argparse.Namespace) -> str:
 #     return path_name
 
 
-def _get_perms_str(path: Path, ns: argparse.Namespace) -> str:
+def _get_perms_str(st: os.stat_result, ns: argparse.Namespace) -> str:
     if ns.p:
-        # perms = oct(path.stat().st_mode & 0o777)
-        return _perms_to_str(path.stat().st_mode)
+        # perms = oct(st.st_mode & 0o777)
+        return _perms_to_str(st.st_mode)
     return ""
 
 
-def _get_owner_and_group(path: Path, ns: argparse.Namespace) -> Tuple[str, str]:
-    owner = ""
-    group = ""
-    if ns.u or ns.g:
-        try:
-            import pwd
-            import grp
-
-            st = path.stat()
-            if ns.u:
-                owner = getattr(pwd, "getpwuid")(st.st_uid).pw_name
-            if ns.g:
-                group = grp.getgrgid(st.st_gid).gr_name
-        except (ImportError, AttributeError):
-            st = path.stat()
-            if ns.u:
-                owner = str(st.st_uid)
-            if ns.g:
-                group = str(st.st_gid)
+# Owners rarely vary within a tree, so each uid and gid is looked up once;
+# ids without a name, and platforms without pwd/grp, show the number
+@functools.lru_cache(maxsize=1024)
+def _uid_name(uid: int) -> str:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except (AttributeError, KeyError):
+        return str(uid)
+
+
+@functools.lru_cache(maxsize=1024)
+def _gid_name(gid: int) -> str:
+    try:
+        return grp.getgrgid(gid).gr_name
+    except (AttributeError, KeyError):
+        return str(gid)
+
+
+def _get_owner_and_group(st: os.stat_result, ns: argparse.Namespace) -> Tuple[str, str]:
+    owner = _uid_name(st.st_uid) if ns.u else ""
+    group = _gid_name(st.st_gid) if ns.g else ""
     return owner, group
 
 
-def _get_size_str(path: Path, ns: argparse.Namespace) -> str:
+def _get_size_str(st: os.stat_result, ns: argparse.Namespace) -> str:
     size_str = ""
     if ns.s or ns.h or ns.si:
-        st_size = path.stat().st_size
+        st_size = st.st_size
         if ns.h:
-            for unit in ["B", "K", "M", "G", "T", "P", "E", "Z"]:
-                if st_size < 1024:
-                    size_str = f"{st_size:.1f}{unit}"
-                    break
-                st_size /= 1024
-            else:
-                size_str = f"{st_size:.1f}Y"
+            # Each unit spans 10 bits, so the bit length picks it directly
+            i = min((st_size.bit_length() - 1) // 10, 8) if st_size else 0
+            size_str = f"{st_size / (1 << 10 * i):.1f}{_UNITS_1024[i]}"
         elif ns.si:
-            for unit in ["B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB"]:
-                if st_size < 1000:
-                    size_str = f"{st_size:.1f}{unit}"
-                    break
-                st_size /= 1000
-            else:
-                size_str = f"{st_size:.1f}YB"
+            i = bisect.bisect_right(_LIMITS_1000, st_size)
+            size_str = f"{st_size / 1000**i:.1f}{_UNITS_1000[i]}"
         else:
             size_str = str(st_size)
     return size_str
 
 
-def _get_datetime_str(path: Path, ns: argparse.Namespace) -> str:
+@functools.lru_cache(maxsize=8192)
+def _fmt_seconds(seconds: int, fmt: str) -> str:
+    return datetime.fromtimestamp(seconds).strftime(fmt)
+
+
+def _get_datetime_str(st: os.stat_result, ns: argparse.Namespace) -> str:
     if ns.timefmt or ns.D:
-        ts = path.stat().st_mtime
-        return datetime.fromtimestamp(ts).strftime(ns.timefmt or "%b %d %H:%M")
+        ts = st.st_mtime
+        fmt = ns.timefmt or "%b %d %H:%M"
+        # Unless %f is asked for, only whole seconds show, so files modified
+        # within the same second share a cached string. Right before a second
+        # boundary the microsecond rounding may carry over, so skip the cache
+        seconds = math.floor(ts)
+        if "%f" not in fmt and ts - seconds < 0.999999:
+            return _fmt_seconds(seconds, fmt)
+        return datetime.fromtimestamp(ts).strftime(fmt)
     return ""
 
 
-def _get_suffix(path: Path, ns: argparse.Namespace) -> str:
+def _get_suffix(
+    path: Path,
+    ns: argparse.Namespace,
+    st: Optional[os.stat_result] = None,
+    is_link: Optional[bool] = None,
+) -> str:
     suffix = ""
     if ns.F:
-        if path.is_dir():
+        if _is_dir(path, st):
             suffix = "/"
-        elif path.is_symlink():
+        elif _is_symlink(path, is_link):
             suffix = "@"
-        elif os.access(path, os.X_OK) and not path.is_dir():
+        elif _is_executable(path, st):
             suffix = "*"
         # можна додати '=', '|', '>' при потребі
     return suffix
 
 
-def _get_inode_str(path: Path, ns: argparse.Namespace) -> str:
-    return str(path.stat().st_ino) if ns.inodes else ""
+def _get_inode_str(st: os.stat_result, ns: argparse.Namespace) -> str:
+    return str(st.st_ino) if ns.inodes else ""
+
 
+def _get_device_str(st: os.stat_result, ns: argparse.Namespace) -> str:
+    return str(st.st_dev) if ns.device else ""
 
-def _get_device_str(path: Path, ns: argparse.Namespace) -> str:
-    return str(path.stat().st_dev) if ns.device else ""
+
+def stat_required(ns: argparse.Namespace) -> bool:
+    """
+    Tells whether fmt_path needs the stat result of the paths it formats.
+    """
+    return bool(
+        ns.p
+        or ns.u
+        or ns.g
+        or ns.s
+        or ns.h
+        or ns.si
+        or ns.timefmt
+        or ns.D
+        or ns.inodes
+        or ns.device
+    )
 
 
 def fmt_error(content: Any, ns: argparse.Namespace) -> str:
@@ -273,7 +357,12 @@ def fmt_error(content: Any, ns: argparse.Namespace) -> str:
     return f"{content}"
 
 
-def fmt_path(path: Path, ns: argparse.Namespace) -> str:
+def fmt_path(
+    path: Path,
+    ns: argparse.Namespace,
+    st: Optional[os.stat_result] = None,
+    is_link: Optional[bool] = None,
+) -> str:
     if not isinstance(path, Path):
         return str(path)
 
@@ -284,21 +373,30 @@ def fmt_path(path: Path, ns: argparse.Namespace) -> str:
     # 3. Quotes
     path_name = _get_quotes(path_name, ns)
     # 4. Colored output
-    path_name = _colorize(path, path_name, ns)
-    # 5. Rules
-    perms = _get_perms_str(path, ns)
-    # 6. Owner and Group
-    owner, group = _get_owner_and_group(path, ns)
-    # 7. Size
-    size_str = _get_size_str(path, ns)
-    # 8. Date
-    datetime_str = _get_datetime_str(path, ns)
-    # 9. Symbols like in ls -F
-    suffix = _get_suffix(path, ns)
+    path_name = _colorize(path, path_name, ns, st, is_link)
+    # 5. Symbols like in ls -F
+    suffix = _get_suffix(path, ns, st, is_link)
+
+    # Without metadata columns there is nothing more to build
+    if not stat_required(ns):
+        return path_name + suffix
+
+    # A single stat result is shared by every metadata column below
+    if st is None:
+        st = path.stat()
+
+    # 6. Rules
+    perms = _get_perms_str(st, ns)
+    # 7. Owner and Group
+    owner, group = _get_owner_and_group(st, ns)
+    # 8. Size
+    size_str = _get_size_str(st, ns)
+    # 9. Date
+    datetime_str = _get_datetime_str(st, ns)
     # 10. Inode
-    inode_str = _get_inode_str(path, ns)
+    inode_str = _get_inode_str(st, ns)
     # 11. Device
-    device_str = _get_device_str(path, ns)
+    device_str = _get_device_str(st, ns)
     # Finalisation
     parts = [perms, owner, group, size_str, inode_str, device_str, datetime_str]
 
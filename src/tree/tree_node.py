@@ -0,0 +1,52 @@
+import os
+from pathlib import Path
+from typing import List, Optional
+
+from .tree_exc import TreeError
+
+__all__ = ("ErrorNode", "TreeNode")
+
+
+class TreeNode:
+    """
+    A single entry of the walked tree.
+    For directories, `contents` holds the children once the directory has
+    been read and is None until then; it is always None for files.
+    `is_link` is None when the walk did not look at the entry type.
+    """
+
+    __slots__ = ("contents", "is_dir", "is_link", "name", "path", "st")
+
+    def __init__(
+        self,
+        path: Path,
+        name: str,
+        st: Optional[os.stat_result] = None,
+        is_dir: bool = False,
+        contents: Optional[List["TreeNode"]] = None,
+        is_link: Optional[bool] = None,
+    ):
+        self.path = path
+        self.name = name
+        self.st = st
+        self.is_dir = is_dir
+        self.contents = contents
+        self.is_link = is_link
+
+    def stat(self) -> os.stat_result:
+        # Prefer the stat result fetched during the walk
+        if self.st is None:
+            self.st = self.path.stat()
+        return self.st
+
+
+class ErrorNode(TreeNode):
+    """
+    Stands in for the contents of a directory that could not be listed.
+    """
+
+    __slots__ = ("error",)
+
+    def __init__(self, error: TreeError):
+        super().__init__(None, "Error")
+        self.error = error